@@ -1,8 +1,21 @@
 import streamlit as st
 import os
+import re
+import math
+import time
+import asyncio
+import queue
+import threading
+import hashlib
+import tempfile
+import functools
+from pathlib import Path
+from collections import Counter
+from difflib import SequenceMatcher
+from html.parser import HTMLParser
 from sec_edgar_downloader import Downloader
 import anthropic
-import tiktoken
+import zstandard as zstd
 
 # Set up Streamlit interface
 st.title("10-K Question Answering with Anthropic")
@@ -13,163 +26,804 @@ question = st.text_area("Ask a question about the firm's 10-K")
 anthropic_api_key = st.text_input("Enter your Anthropic API Key", type="password")
 model = st.selectbox(
     "Select Anthropic Model",
-    ('claude-3-opus-20240229', 'claude-3-sonnet-20240229', 'claude-3-haiku-20240307')
+    (
+        'claude-3-5-haiku-20241022', 'claude-3-5-sonnet-20241022', 'claude-3-opus-20240229',
+        'claude-3-sonnet-20240229', 'claude-3-haiku-20240307',
+    )
+)
+section = st.selectbox(
+    "Section of the 10-K to search",
+    (
+        'Entire filing', 'Item 1. Business', 'Item 1A. Risk Factors', 'Item 3. Legal Proceedings',
+        "Item 7. Management's Discussion and Analysis", 'Item 7A. Market Risk Disclosures',
+        'Item 8. Financial Statements',
+    )
+)
+use_batch_api = st.checkbox(
+    "Use the Message Batches API for long filings (50% cheaper, but may take several minutes)"
 )
 
-# Function to fetch 10-K filing
-def fetch_10k_filing(ticker, year):
-    """Fetches the 10-K filing for a given ticker and year."""
-    try:
-        # Initialize the downloader
-        # The download directory is set to the current directory
-        dl = Downloader()
+# Extracted filings are cached here so repeat queries skip the EDGAR download
+FILING_CACHE_DIR = Path(".filing_cache")
+
+# Cached filings are zstd-compressed at this level
+FILING_CACHE_COMPRESSION_LEVEL = 3
+
+# Bumped whenever the extracted text format changes, so stale entries are not reused
+FILING_CACHE_VERSION = 2
+
+# Least recently used filings are evicted once the cache grows past this size
+FILING_CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+# Temporary files older than this many seconds were left by an interrupted
+# cache write and are removed
+FILING_CACHE_TMP_MAX_AGE = 3600
+
+# Maximum number of filings also held in memory across Streamlit reruns
+FILING_MEMORY_CACHE_ENTRIES = 32
+
+# SEC EDGAR requires requests to identify the caller
+EDGAR_COMPANY_NAME = os.environ.get("SEC_EDGAR_COMPANY_NAME", "10-K Question Answering")
+EDGAR_EMAIL_ADDRESS = os.environ.get("SEC_EDGAR_EMAIL_ADDRESS", "your.email@example.com")
+
+
+class FilingNotFoundError(Exception):
+    """Raised when a downloaded filing has no readable text content."""
+
+
+# 10-K items in filing order, mapped to the start of each item's title, used
+# to recognise section headings
+TEN_K_ITEMS = {
+    "1": r"Business",
+    "1A": r"Risk\s+Factors",
+    "1B": r"Unresolved\s+Staff\s+Comments",
+    "1C": r"Cybersecurity",
+    "2": r"Properties",
+    "3": r"Legal\s+Proceedings",
+    "4": r"(?:Mine\s+Safety|Submission\s+of\s+Matters|\(?Removed|\[?Reserved)",
+    "5": r"Market\s+for",
+    "6": r"(?:Selected\s+Financial\s+Data|\[?Reserved)",
+    "7": r"Management.s\s+Discussion",
+    "7A": r"Quantitative\s+and\s+Qualitative",
+    "8": r"Financial\s+Statements",
+    "9": r"Changes\s+in\s+and\s+Disagreements",
+    "9A": r"Controls\s+and\s+Procedures",
+    "9B": r"Other\s+Information",
+    "9C": r"Disclosure\s+Regarding\s+Foreign",
+    "10": r"Directors",
+    "11": r"Executive\s+Compensation",
+    "12": r"Security\s+Ownership",
+    "13": r"Certain\s+Relationships",
+    "14": r"Principal\s+Account",
+    "15": r"Exhibits",
+    "16": r"Form\s+10-K\s+Summary",
+}
+
+# A section heading: "Item N" at the start of a line, optionally after the
+# part ("PART II - Item 7") and with items that share a heading ("Items 1
+# and 2"), followed by the first item's title
+TEN_K_HEADING_PATTERN = re.compile(
+    r"^[ \t]*(?:Part[ \t]+[IV]+\b[ \t]*[,.:\-\u2013\u2014]?[ \t]*)?Items?\s+(?:"
+    + "|".join(
+        rf"(?P<item_{item}>{item})\b(?:\s*(?:,\s*and|,|and|&)\s*\d+[A-C]?\b)*[ \t]*[.:\-\u2013\u2014]?\s*{title}"
+        for item, title in TEN_K_ITEMS.items()
+    )
+    + ")",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+# What follows a table of contents heading: nothing but a page number
+TABLE_OF_CONTENTS_PAGE_PATTERN = re.compile(r"\s*(?:Page\s*)?[A-Z]?[\d\s.,\-\u2013\u2014]*", re.IGNORECASE)
+
+# Approximate number of characters per Claude token, used to size chunks
+CHARS_PER_TOKEN = 3
+
+# Maximum number of characters of filing text sent to the model for one question
+MAX_INPUT_CHARS = 400_000
+
+# Number of chunks, ranked by keyword relevance to the question, sent to the model
+RELEVANT_CHUNKS = 8
+
+# Common words ignored when matching question keywords against chunks
+KEYWORD_STOPWORDS = frozenset({
+    "the", "and", "for", "are", "was", "were", "what", "which", "who", "whom",
+    "how", "why", "when", "where", "does", "did", "has", "have", "had", "its",
+    "their", "this", "that", "these", "those", "with", "from", "into", "about",
+    "company", "firm", "filing", "year", "can", "you", "any", "all",
+})
+
+# Number of chunks sent together in a single Anthropic request; at 4,000
+# tokens per chunk this stays well inside the 200k-token context window
+CHUNKS_PER_REQUEST = 32
+
+# Polling schedule (in seconds) for Message Batches used when a filing spans
+# several requests
+BATCH_POLL_INITIAL_DELAY = 1
+BATCH_POLL_MAX_DELAY = 30
+BATCH_POLL_TIMEOUT = 900
+
+# Maximum number of Anthropic requests in flight at once
+MAX_CONCURRENT_REQUESTS = 10
+
+# Bounds on the cached Anthropic clients (one per API key), with the TTL in seconds
+ANTHROPIC_CLIENT_CACHE_ENTRIES = 16
+ANTHROPIC_CLIENT_CACHE_TTL = 3600
+
+# Answers from these models that cannot answer the question are retried once
+# with the stronger model they map to
+ESCALATION_MODELS = {
+    'claude-3-5-haiku-20241022': 'claude-sonnet-4-5-20250929',
+    'claude-3-haiku-20240307': 'claude-sonnet-4-5-20250929',
+}
+
+# Phrases marking an answer as low-confidence and eligible for escalation
+LOW_CONFIDENCE_PHRASES = ("cannot answer", "insufficient information")
 
+# Prefix of the message recorded in place of a failed chunk request
+REQUEST_ERROR_PREFIX = "Error processing request"
+
+# Two partial answers at least this similar are treated as the same answer
+# and returned without a synthesis call
+SYNTHESIS_SIMILARITY_THRESHOLD = 0.8
+
+# System prompt shared by every chunk request
+CHUNK_SYSTEM_PROMPT = """You are an AI assistant specifically designed to answer questions based on provided text snippets from a company's 10-K filing.
+Read the following text carefully and answer the question based *only* on the information contained within this text.
+If the text does not contain enough information to answer the question, state that you cannot answer based on the provided text."""
+
+# Prompt templates, filled in with str.format
+CHUNK_QUESTION_TEMPLATE = """User Question:
+{question}
+
+Answer (based ONLY on the provided text snippets):"""
+
+SYNTHESIS_PROMPT_TEMPLATE = """You have been provided with several partial answers to a question based on different chunks of a 10-K filing.
+Synthesize these partial answers into a single, coherent, and comprehensive answer to the original question.
+If some partial answers indicate they cannot answer based on their specific chunk, ignore those and focus on the ones that provide relevant information.
+
+Original Question: {question}
+
+Partial Answers:
+---
+{partial_answers}
+---
+
+Synthesized Final Answer:"""
+
+
+def _filing_cache_path(ticker, year):
+    """Returns the on-disk cache path for a given ticker and year."""
+    key = hashlib.sha256(f"{ticker}-{year}-v{FILING_CACHE_VERSION}".encode()).hexdigest()
+    return FILING_CACHE_DIR / f"{key}.txt.zst"
+
+@st.cache_resource(show_spinner=False)
+def _init_edgar():
+    """
+    Returns the SEC EDGAR downloader shared across Streamlit reruns.
+
+    Creating a Downloader fetches the SEC ticker-to-CIK mapping, so this
+    only happens once per process.
+    """
+    # The download directory is set to the current directory
+    return Downloader(EDGAR_COMPANY_NAME, EDGAR_EMAIL_ADDRESS)
+
+def _find_downloaded_filing(ticker, year):
+    """Returns the path of an already downloaded 10-K filed in the given year, or None."""
+    # The downloader saves each filing as
+    # sec-edgar-filings/{ticker}/10-K/{accession number}/full-submission.txt,
+    # where the middle segment of the accession number is the two-digit year
+    # the filing was submitted
+    matches = sorted(Path("sec-edgar-filings", ticker, "10-K").glob(f"*-{year % 100:02d}-*/*.txt"))
+    return matches[0] if matches else None
+
+@functools.lru_cache(maxsize=128)
+def _find_filing(ticker, year):
+    """
+    Returns the path of the 10-K filing for a given ticker and year,
+    downloading it from EDGAR only if it is not already on disk.
+    """
+    file_path = _find_downloaded_filing(ticker, year)
+    if file_path is None:
         # Download the 10-K filing
-        # The downloader saves filings to a specific directory structure
         # We will download only one filing to ensure we get the correct one for the year
-        dl.get("10-K", ticker, limit=1, after=f"{year}-01-01", before=f"{year}-12-31")
-
-        # Construct the expected file path based on the downloader's structure
-        # and find the exact filename within the directory
-        download_path = os.path.join("sec-edgar-filings", ticker, "10-K")
-        filing_content = ""
-        filing_found = False
-
-        if os.path.exists(download_path):
-            # Walk through the downloaded directory to find the filing text file
-            for root, dirs, files in os.walk(download_path):
-                for file in files:
-                    if file.endswith(".txt"): # 10-K filings are often in text format
-                        file_path = os.path.join(root, file)
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            filing_content = f.read()
-                        filing_found = True
-                        break # Assume the first .txt file found is the 10-K
-                if filing_found:
-                    break # Stop searching once content is found
-
-        if not filing_content:
-             return f"Could not find content in downloaded filing for {ticker} in {year}."
-
-        return filing_content
+        _init_edgar().get("10-K", ticker, limit=1, after=f"{year}-01-01", before=f"{year}-12-31")
+        file_path = _find_downloaded_filing(ticker, year)
+
+    if file_path is None:
+        raise FilingNotFoundError(f"Could not find content in downloaded filing for {ticker} in {year}.")
+
+    return file_path
+
+def _read_primary_document(file_path):
+    """
+    Reads the main 10-K document from a full submission file.
+
+    The submission also bundles every exhibit, XBRL file and uuencoded image
+    after the 10-K itself, so the file is streamed line by line and reading
+    stops at the end of the first <DOCUMENT>.
+    """
+    lines = []
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            lines.append(line)
+            if line.startswith("</DOCUMENT>"):
+                break
+    return "".join(lines)
+
+class _FilingTextExtractor(HTMLParser):
+    """Collects the visible text of an SGML/HTML filing document."""
+
+    # Tags whose content is markup or metadata rather than filing text
+    SKIPPED_TAGS = {"script", "style", "head", "ix:header", "xbrl"}
+
+    # Tags that start a new line of text
+    BLOCK_TAGS = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6"}
+
+    # Table cells are separated by a space so adjacent columns do not run together
+    CELL_TAGS = {"td", "th"}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skip_depth += 1
+        self._separate(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+        self._separate(tag)
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+    def _separate(self, tag):
+        if tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+        elif tag in self.CELL_TAGS:
+            self.parts.append(" ")
+
+def _extract_filing_text(raw_document):
+    """
+    Converts a raw SGML/HTML filing document into plain text, keeping one
+    line per block element and collapsing runs of spaces within each line.
+    """
+    extractor = _FilingTextExtractor()
+    extractor.feed(raw_document)
+    extractor.close()
+    text = re.sub(r"[^\S\n]+", " ", "".join(extractor.parts))
+    return re.sub(r" ?\n[\s]*", "\n", text).strip()
+
+def _evict_filing_cache():
+    """
+    Removes the least recently used cached filings until the cache fits in
+    FILING_CACHE_MAX_BYTES.
+
+    Uncompressed *.txt entries from before the cache was compressed are
+    never read, and old *.tmp files were left by interrupted writes, so both
+    are always removed.
+    """
+    now = time.time()
+    entries = []
+    for entry in FILING_CACHE_DIR.iterdir():
+        stat = entry.stat()
+        if entry.suffix == ".txt" or (entry.suffix == ".tmp" and now - stat.st_mtime > FILING_CACHE_TMP_MAX_AGE):
+            entry.unlink(missing_ok=True)
+        elif entry.name.endswith(".txt.zst"):
+            entries.append((stat.st_mtime, stat.st_size, entry))
+    entries.sort()
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total_bytes <= FILING_CACHE_MAX_BYTES:
+            break
+        entry.unlink(missing_ok=True)
+        total_bytes -= size
 
+# Function to fetch 10-K filing
+@st.cache_data(show_spinner=False, max_entries=FILING_MEMORY_CACHE_ENTRIES, ttl=86400)
+def _load_10k_filing(ticker, year):
+    """
+    Loads the 10-K filing text for a given ticker and year, reading it from
+    the on-disk cache when present and downloading it from EDGAR otherwise.
+
+    Failures are raised rather than returned so that they are never cached.
+    """
+    cache_path = _filing_cache_path(ticker, year)
+    if cache_path.exists():
+        try:
+            filing_content = zstd.ZstdDecompressor().decompress(cache_path.read_bytes()).decode("utf-8")
+            # Mark the entry as recently used for cache eviction
+            cache_path.touch()
+            return filing_content
+        except (zstd.ZstdError, UnicodeDecodeError) as e:
+            # A corrupt entry would fail on every hit, so drop it and fetch again
+            print(f"Discarding corrupt filing cache entry {cache_path}: {e}")
+            cache_path.unlink(missing_ok=True)
+
+    # Strip the markup once so that cache hits skip parsing entirely and the
+    # prompts carry only the filing text
+    filing_content = _extract_filing_text(_read_primary_document(_find_filing(ticker, year)))
+
+    if not filing_content:
+        raise FilingNotFoundError(f"Could not find content in downloaded filing for {ticker} in {year}.")
+
+    # Write to a temporary file and move it into place, so concurrent writers
+    # or a crash mid-write never leave a truncated entry behind
+    FILING_CACHE_DIR.mkdir(exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=FILING_CACHE_DIR, suffix=".tmp", delete=False) as f:
+        try:
+            f.write(zstd.ZstdCompressor(level=FILING_CACHE_COMPRESSION_LEVEL).compress(filing_content.encode("utf-8")))
+            f.close()
+            os.replace(f.name, cache_path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+    _evict_filing_cache()
+    return filing_content
+
+def fetch_10k_filing(ticker, year):
+    """Fetches the 10-K filing for a given ticker and year."""
+    try:
+        return _load_10k_filing(ticker, year)
+    except FilingNotFoundError as e:
+        return str(e)
     except Exception as e:
         return f"An error occurred: {e}"
 
+def extract_section(text, section_name):
+    """
+    Extracts a single item, such as "Item 1A. Risk Factors", from the plain
+    text of a 10-K so that only that section is sent to the model.
+
+    Only true headings count: "Item N" at the start of a line followed by
+    that item's title, so cross-references such as "see Part II, Item 7"
+    are ignored. A section runs from its heading to the next heading of a
+    later item. The table of contents repeats every heading, so spans that
+    run into another heading of the same item, or that hold nothing after
+    the heading line but a page number, are skipped. The longest remaining
+    span is taken as the section body.
+
+    Args:
+        text: The plain text of the 10-K filing.
+        section_name: A section label starting with "Item N.".
+
+    Returns:
+        The text of the section, or an empty string if it was not found.
+    """
+    item = section_name.split()[1].rstrip(".").upper()
+    item_order = list(TEN_K_ITEMS)
+    headings = [
+        (match.start(), match.end(), item_order.index(match.lastgroup.removeprefix("item_")))
+        for match in TEN_K_HEADING_PATTERN.finditer(text)
+    ]
+
+    item_index = item_order.index(item)
+    section_text = ""
+    for position, (start, heading_end, heading_index) in enumerate(headings):
+        if heading_index != item_index:
+            continue
+        end = next(
+            (heading for heading in headings[position + 1:] if heading[2] >= item_index),
+            None,
+        )
+        if end and end[2] == item_index:
+            continue
+        section_end = end[0] if end else len(text)
+        body = text[heading_end:section_end].partition("\n")[2]
+        if TABLE_OF_CONTENTS_PAGE_PATTERN.fullmatch(body):
+            continue
+        candidate = text[start:section_end]
+        if len(candidate) > len(section_text):
+            section_text = candidate
+    return section_text.strip()
+
 # Function to process 10-K text (chunking)
-def process_10k_text(text, model_name="claude-3-haiku-20240307", max_chunk_tokens=4000):
+def process_10k_text(text, max_chunk_tokens=4000):
     """
     Processes the raw 10-K text by splitting it into chunks that respect
-    the context window limits of the specified language model.
+    the context window limits of the Anthropic models.
+
+    Chunks are sized by characters using CHARS_PER_TOKEN as an estimate of
+    Claude's tokenization, which avoids encoding the whole filing.
 
     Args:
         text: The raw text of the 10-K filing.
-        model_name: The name of the Anthropic model (used to get encoding).
         max_chunk_tokens: The maximum number of tokens per chunk, leaving
                           room for prompt and answer tokens.
 
     Returns:
         A list of text chunks.
     """
-    try:
-        encoding = tiktoken.encoding_for_model(model_name)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+    chunk_chars = max_chunk_tokens * CHARS_PER_TOKEN
+    return [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
 
-    tokens = encoding.encode(text)
-    chunks = []
-    current_chunk_tokens = []
+def select_relevant_chunks(question, text_chunks, top_k=RELEVANT_CHUNKS):
+    """
+    Keeps only the chunks most relevant to the question so that unrelated
+    sections (exhibit lists, signatures, glossaries) are never sent to the
+    model.
 
-    for token in tokens:
-        current_chunk_tokens.append(token)
-        if len(current_chunk_tokens) >= max_chunk_tokens:
-            chunks.append(encoding.decode(current_chunk_tokens))
-            current_chunk_tokens = []
+    Chunks are ranked with BM25-style weighting of the question's keywords.
 
-    # Add the last chunk if it's not empty
-    if current_chunk_tokens:
-        chunks.append(encoding.decode(current_chunk_tokens))
+    Args:
+        question: The user's question about the 10-K.
+        text_chunks: A list of text chunks from the processed 10-K.
+        top_k: The maximum number of chunks to keep.
 
-    return chunks
+    Returns:
+        A list of (chunk_number, chunk) pairs, numbered from 1 by position in
+        text_chunks, for the top_k highest scoring chunks in their original
+        order, or for all chunks if there are no more than top_k or none
+        match the question.
+    """
+    numbered_chunks = list(enumerate(text_chunks, start=1))
+    keywords = {
+        word for word in re.findall(r"[a-z0-9]+", question.lower())
+        if len(word) > 2 and word not in KEYWORD_STOPWORDS
+    }
+    if not keywords or len(text_chunks) <= top_k:
+        return numbered_chunks
+
+    term_counts = [
+        Counter(word for word in re.findall(r"[a-z0-9]+", chunk.lower()) if word in keywords)
+        for chunk in text_chunks
+    ]
+    document_frequency = Counter(word for counts in term_counts for word in counts)
+    idf = {
+        word: math.log(1 + (len(text_chunks) - df + 0.5) / (df + 0.5))
+        for word, df in document_frequency.items()
+    }
+
+    # Chunks are all the same length, so BM25's length normalization drops out
+    k1 = 1.2
+    scores = [
+        sum(idf[word] * count * (k1 + 1) / (count + k1) for word, count in counts.items())
+        for counts in term_counts
+    ]
+    if not any(scores):
+        return numbered_chunks
+
+    top_indices = sorted(range(len(text_chunks)), key=lambda i: scores[i], reverse=True)[:top_k]
+    return [numbered_chunks[i] for i in sorted(top_indices)]
+
+def limit_input_chunks(numbered_chunks, max_chars=MAX_INPUT_CHARS):
+    """
+    Bounds the filing text sent for one question, which matters when
+    select_relevant_chunks falls back to every chunk of a long filing.
 
-# Function to interact with Anthropic API
-def get_answer_from_anthropic(api_key, model_name, question, text_chunks):
+    Args:
+        numbered_chunks: A list of (chunk_number, chunk) pairs from
+                         select_relevant_chunks.
+        max_chars: The maximum total length of the chunks to keep.
+
+    Returns:
+        The leading (chunk_number, chunk) pairs whose combined length fits
+        in max_chars.
     """
-    Sends the user's question and text chunks from the 10-K to the Anthropic API
-    to get an answer.
+    total_chars = 0
+    for i, (_, chunk) in enumerate(numbered_chunks):
+        total_chars += len(chunk)
+        if total_chars > max_chars:
+            return numbered_chunks[:i]
+    return numbered_chunks
+
+def _build_chunk_prompt(question, chunk_group, total_chunks, cache_snippets):
+    """
+    Builds the user message content for a group of 10-K chunks.
 
     Args:
-        api_key: The Anthropic API key.
-        model_name: The name of the Anthropic model to use.
         question: The user's question about the 10-K.
-        text_chunks: A list of text chunks from the processed 10-K.
+        chunk_group: A list of (chunk_number, chunk) pairs.
+        total_chunks: The number of chunks in the whole processed filing.
+        cache_snippets: Whether to end the snippets with a prompt caching
+                        breakpoint, so that follow-up questions about the
+                        same filing reuse the cached system prompt and
+                        snippets.
+    """
+    # Assemble the snippets with a single join so each chunk is copied once
+    pieces = [f"10-K Text Snippets ({len(chunk_group)} of {total_chunks} chunks):"]
+    for chunk_number, chunk in chunk_group:
+        pieces.append(f"\n\n---CHUNK {chunk_number}---\n")
+        pieces.append(chunk)
+
+    snippets = {"type": "text", "text": "".join(pieces)}
+    if cache_snippets:
+        snippets["cache_control"] = {"type": "ephemeral"}
+
+    return [
+        snippets,
+        {
+            "type": "text",
+            "text": CHUNK_QUESTION_TEMPLATE.format(question=question),
+        },
+    ]
+
+def _build_chunk_request(model_name, prompt):
+    """Returns the Messages API parameters for one prompt from _build_chunk_prompt."""
+    return {
+        "model": model_name,
+        "max_tokens": 2048, # Adjust based on expected answer length
+        "system": CHUNK_SYSTEM_PROMPT,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+    }
+
+def _is_low_confidence(answer):
+    """Returns whether an answer says the text could not answer the question."""
+    answer = answer.lower()
+    return any(phrase in answer for phrase in LOW_CONFIDENCE_PHRASES)
+
+async def _answer_prompts_with_batch(client, model_name, prompts):
+    """
+    Submits all prompts as one Anthropic Message Batch, waits for it to finish
+    and returns the responses in the same order as the prompts.
+
+    Args:
+        client: An AsyncAnthropic client.
+        model_name: The name of the Anthropic model to use.
+        prompts: A list of user message contents from _build_chunk_prompt.
 
     Returns:
-        A string containing the synthesized answer or an error message.
+        A list of response texts, with an error message in place of any
+        request that did not succeed.
+    """
+    batch = await client.messages.batches.create(
+        requests=[
+            {"custom_id": f"chunk-{i}", "params": _build_chunk_request(model_name, prompt)}
+            for i, prompt in enumerate(prompts)
+        ]
+    )
+
+    # Poll with exponential backoff until the batch has finished processing
+    delay = BATCH_POLL_INITIAL_DELAY
+    deadline = time.monotonic() + BATCH_POLL_TIMEOUT
+    while batch.processing_status != "ended":
+        if time.monotonic() >= deadline:
+            await client.messages.batches.cancel(batch.id)
+            raise TimeoutError(f"Message batch {batch.id} did not finish within {BATCH_POLL_TIMEOUT} seconds.")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX_DELAY)
+        batch = await client.messages.batches.retrieve(batch.id)
+
+    all_responses = [f"{REQUEST_ERROR_PREFIX} {i+1}: no result returned" for i in range(len(prompts))]
+    async for entry in await client.messages.batches.results(batch.id):
+        i = int(entry.custom_id.removeprefix("chunk-"))
+        if entry.result.type == "succeeded":
+            all_responses[i] = entry.result.message.content[0].text
+        else:
+            all_responses[i] = f"{REQUEST_ERROR_PREFIX} {i+1}: request {entry.result.type}"
+
+    # Retry low-confidence answers once with the escalation model, keeping
+    # the original answer for any retry that fails
+    escalation_model = ESCALATION_MODELS.get(model_name)
+    if escalation_model:
+        retry_indices = [
+            i for i, response in enumerate(all_responses)
+            if not response.startswith(REQUEST_ERROR_PREFIX) and _is_low_confidence(response)
+        ]
+        retried = await _answer_prompts_concurrently(
+            client, escalation_model, [prompts[i] for i in retry_indices]
+        )
+        for i, response in zip(retry_indices, retried):
+            if not response.startswith(REQUEST_ERROR_PREFIX):
+                all_responses[i] = response
+
+    return all_responses
+
+async def _answer_prompts_concurrently(client, model_name, prompts):
+    """
+    Sends all prompts to the Anthropic API concurrently, with at most
+    MAX_CONCURRENT_REQUESTS in flight, and returns the responses in the same
+    order as the prompts.
+
+    Args:
+        client: An AsyncAnthropic client.
+        model_name: The name of the Anthropic model to use.
+        prompts: A list of user message contents from _build_chunk_prompt.
+
+    Returns:
+        A list of response texts, with an error message in place of any
+        request that failed.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def answer_prompt(prompt, i):
+        async with semaphore:
+            try:
+                message = await client.messages.create(**_build_chunk_request(model_name, prompt))
+                answer = message.content[0].text
+            except Exception as e:
+                print(f"{REQUEST_ERROR_PREFIX} {i+1}: {e}")
+                return f"{REQUEST_ERROR_PREFIX} {i+1}: {e}"
+
+            # Retry a low-confidence answer once with the escalation model,
+            # keeping the original answer if the retry fails
+            escalation_model = ESCALATION_MODELS.get(model_name)
+            if escalation_model and _is_low_confidence(answer):
+                try:
+                    message = await client.messages.create(**_build_chunk_request(escalation_model, prompt))
+                    answer = message.content[0].text
+                except Exception as e:
+                    print(f"Error escalating request {i+1} to {escalation_model}: {e}")
+            return answer
+
+    return await asyncio.gather(*(answer_prompt(prompt, i) for i, prompt in enumerate(prompts)))
+
+@st.cache_resource(show_spinner=False)
+def _get_event_loop():
+    """
+    Returns a background event loop shared across Streamlit reruns.
+
+    Cached async clients must always run on the same loop, because their
+    pooled connections are bound to the loop that opened them.
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+def _run_async(coroutine):
+    """Runs a coroutine on the shared event loop and returns its result."""
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_event_loop()).result()
+
+@st.cache_resource(show_spinner=False, max_entries=ANTHROPIC_CLIENT_CACHE_ENTRIES, ttl=ANTHROPIC_CLIENT_CACHE_TTL)
+def get_anthropic(api_key):
     """
-    client = anthropic.Anthropic(api_key=api_key)
-    all_responses = []
+    Returns an AsyncAnthropic client shared across Streamlit reruns, so its
+    connections are reused. Clients are keyed by API key, so the cache is
+    bounded in size and lifetime to avoid holding every visitor's key.
+    """
+    return anthropic.AsyncAnthropic(api_key=api_key)
+
+def _stream_text(client, request):
+    """
+    Streams the answer text of a single Anthropic request, yielding each
+    piece as it arrives so it can be rendered with st.write_stream.
+
+    Args:
+        client: An AsyncAnthropic client.
+        request: The Messages API parameters for the request.
 
-    for i, chunk in enumerate(text_chunks):
+    Yields:
+        Pieces of the response text. Errors from the request are raised once
+        the stream ends, and closing the generator early cancels the request.
+    """
+    pieces = queue.Queue()
+    finished = object()
+
+    async def produce():
         try:
-            # Construct a prompt that clearly instructs the model
-            prompt = f"""You are an AI assistant specifically designed to answer questions based on provided text snippets from a company's 10-K filing.
-Read the following text carefully and answer the question based *only* on the information contained within this text.
-If the text does not contain enough information to answer the question, state that you cannot answer based on the provided text.
+            async with client.messages.stream(**request) as stream:
+                async for text in stream.text_stream:
+                    pieces.put(text)
+        finally:
+            pieces.put(finished)
 
-10-K Text Snippet (Chunk {i+1}/{len(text_chunks)}):
----
-{chunk}
----
+    future = asyncio.run_coroutine_threadsafe(produce(), _get_event_loop())
+    try:
+        while (piece := pieces.get()) is not finished:
+            yield piece
+        future.result()
+    finally:
+        # Stop the request if the consumer goes away before the stream ends,
+        # so no further tokens are generated and queued
+        future.cancel()
+
+def _stream_with_escalation(client, request):
+    """
+    Streams a chunk request and, if the answer is low-confidence, follows it
+    with the answer from the escalation model for the requested model.
 
-User Question:
-{question}
+    The first answer is already on screen by the time it is escalated, so a
+    failed retry is reported in the stream rather than raised.
+    """
+    pieces = []
+    for piece in _stream_text(client, request):
+        pieces.append(piece)
+        yield piece
+
+    escalation_model = ESCALATION_MODELS.get(request["model"])
+    if escalation_model and _is_low_confidence("".join(pieces)):
+        yield f"\n\n---\n\n*Retrying with {escalation_model}:*\n\n"
+        try:
+            yield from _stream_text(client, {**request, "model": escalation_model})
+        except Exception as e:
+            print(f"Error escalating to {escalation_model}: {e}")
+            yield f"\n\n*The retry failed, so the answer above stands. Error: {e}*"
 
-Answer (based ONLY on the provided text snippet):"""
+def _stream_synthesis(client, request, partial_answers):
+    """Streams the synthesized answer, falling back to the partial answers if synthesis fails."""
+    try:
+        yield from _stream_text(client, request)
+    except Exception as e:
+        print(f"Error during synthesis: {e}")
+        yield f"Generated partial answers but failed to synthesize: {partial_answers}\nError: {e}"
 
-            message = client.messages.create(
-                model=model_name,
-                max_tokens=1024, # Adjust based on expected answer length
-                messages=[
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            all_responses.append(message.content[0].text)
+# Function to interact with Anthropic API
+def get_answer_from_anthropic(api_key, model_name, question, numbered_chunks, total_chunks, use_batch_api=False):
+    """
+    Sends the user's question and text chunks from the 10-K to the Anthropic API
+    to get an answer.
+
+    Args:
+        api_key: The Anthropic API key.
+        model_name: The name of the Anthropic model to use.
+        question: The user's question about the 10-K.
+        numbered_chunks: A list of (chunk_number, chunk) pairs from
+                         select_relevant_chunks.
+        total_chunks: The number of chunks in the whole processed 10-K.
+        use_batch_api: Whether to submit chunks that span several requests
+                       through the Message Batches API instead of sending
+                       the requests concurrently.
 
+    Returns:
+        Either an iterator that streams the final answer as it is generated,
+        or a string containing a complete answer or an error message.
+    """
+    client = get_anthropic(api_key)
+
+    # Group the chunks so the instructions and question are sent once per
+    # request rather than once per chunk. The snippets are only cached when
+    # every chunk is sent: a selection that depends on the question changes
+    # with each question, so its cache entry would never be read back
+    cache_snippets = len(numbered_chunks) == total_chunks
+    prompts = [
+        _build_chunk_prompt(question, numbered_chunks[i:i + CHUNKS_PER_REQUEST], total_chunks, cache_snippets)
+        for i in range(0, len(numbered_chunks), CHUNKS_PER_REQUEST)
+    ]
+
+    if len(prompts) == 1:
+        # A single request answers the question directly, so stream it
+        return _stream_with_escalation(client, _build_chunk_request(model_name, prompts[0]))
+
+    if use_batch_api:
+        # Submit the requests together as a Message Batch so they are
+        # processed server-side at a lower cost
+        try:
+            all_responses = _run_async(_answer_prompts_with_batch(client, model_name, prompts))
         except Exception as e:
-            print(f"Error processing chunk {i+1}: {e}")
-            all_responses.append(f"Error processing chunk {i+1}: {e}")
+            print(f"Error processing message batch: {e}")
+            return f"Error processing message batch: {e}"
+    else:
+        all_responses = _run_async(_answer_prompts_concurrently(client, model_name, prompts))
 
     synthesized_answer = "\n\n---\n\n".join(all_responses)
 
     if not synthesized_answer.strip():
         return "Could not generate an answer based on the provided text."
 
-    if len(text_chunks) > 1 and len([resp for resp in all_responses if "cannot answer" not in resp.lower()]) > 1:
-         try:
-             synthesis_prompt = f"""You have been provided with several partial answers to a question based on different chunks of a 10-K filing.
-             Synthesize these partial answers into a single, coherent, and comprehensive answer to the original question.
-             If some partial answers indicate they cannot answer based on their specific chunk, ignore those and focus on the ones that provide relevant information.
-
-             Original Question: {question}
-
-             Partial Answers:
-             ---
-             {synthesized_answer}
-             ---
-
-             Synthesized Final Answer:"""
-             synthesis_message = client.messages.create(
-                 model=model_name,
-                 max_tokens=1024,
-                 messages=[
-                     {"role": "user", "content": synthesis_prompt}
-                 ]
-             )
-             return synthesis_message.content[0].text
-         except Exception as e:
-             print(f"Error during synthesis: {e}")
-             return f"Generated partial answers but failed to synthesize: {synthesized_answer}\nError: {e}"
+    # Only synthesize when there are genuinely different answers to combine.
+    # Failed requests are left out so an error is never returned as the answer
+    useful_responses = [
+        resp for resp in all_responses
+        if not resp.startswith(REQUEST_ERROR_PREFIX) and not _is_low_confidence(resp)
+    ]
+    if len(useful_responses) == 1:
+        return useful_responses[0]
+    if len(useful_responses) == 2:
+        first, second = useful_responses
+        if SequenceMatcher(None, first, second).ratio() > SYNTHESIS_SIMILARITY_THRESHOLD:
+            return max(useful_responses, key=len)
+
+    if len(useful_responses) > 1:
+        synthesis_request = {
+            "model": model_name,
+            "max_tokens": 1024,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": SYNTHESIS_PROMPT_TEMPLATE.format(
+                        question=question, partial_answers=synthesized_answer
+                    ),
+                }
+            ],
+        }
+        return _stream_synthesis(client, synthesis_request, synthesized_answer)
 
     return synthesized_answer
 
@@ -182,22 +836,54 @@ if st.button("Get Answer"):
         st.info(f"Fetching 10-K for {ticker} ({year})...")
         filing_text = fetch_10k_filing(ticker, year)
 
-        if "Error" in filing_text or "Could not find content" in filing_text:
+        if filing_text.startswith(("An error occurred", "Could not find content")):
             st.error(filing_text)
         else:
             st.success("10-K fetched successfully. Processing...")
-            processed_chunks = process_10k_text(filing_text, model_name=model)
+            if section != 'Entire filing':
+                section_text = extract_section(filing_text, section)
+                if section_text:
+                    filing_text = section_text
+                else:
+                    st.warning(f"Could not find {section} in the 10-K. Searching the entire filing instead.")
+            processed_chunks = process_10k_text(filing_text)
 
             if not processed_chunks:
                  st.warning("Could not process the 10-K text into usable chunks.")
             else:
-                st.success(f"10-K processed into {len(processed_chunks)} chunks. Getting answer from Anthropic...")
-
-                answer = get_answer_from_anthropic(anthropic_api_key, model, question, processed_chunks)
-
-                if "Error" in answer or "Could not generate an answer" in answer:
+                relevant_chunks = select_relevant_chunks(question, processed_chunks)
+                if len(relevant_chunks) == len(processed_chunks):
+                    # Nothing was filtered out, either because the text is
+                    # short or because no chunk matched the question's keywords
+                    chunk_summary = f"10-K processed into {len(processed_chunks)} chunks, none of which were filtered out."
+                else:
+                    chunk_summary = (
+                        f"10-K processed into {len(processed_chunks)} chunks, {len(relevant_chunks)} of which "
+                        "are relevant to the question."
+                    )
+                st.success(f"{chunk_summary} Getting answer from Anthropic...")
+                input_chunks = limit_input_chunks(relevant_chunks)
+                if len(input_chunks) < len(relevant_chunks):
+                    st.warning(
+                        f"Only the first {len(input_chunks)} of {len(relevant_chunks)} chunks fit in the "
+                        f"{MAX_INPUT_CHARS:,}-character input limit, so the rest of the 10-K is not searched. "
+                        "Selecting a section or asking a more specific question narrows the search."
+                    )
+
+                answer = get_answer_from_anthropic(
+                    anthropic_api_key, model, question, input_chunks, len(processed_chunks), use_batch_api
+                )
+
+                if isinstance(answer, str) and ("Error" in answer or "Could not generate an answer" in answer):
                     st.error(answer)
                 else:
-                    st.success("Answer received!")
                     st.write("## Answer:")
-                    st.write(answer)
\ No newline at end of file
+                    try:
+                        if isinstance(answer, str):
+                            st.write(answer)
+                        else:
+                            # Render the answer as it is generated
+                            st.write_stream(answer)
+                        st.success("Answer received!")
+                    except Exception as e:
+                        st.error(f"Error generating answer: {e}")
\ No newline at end of file